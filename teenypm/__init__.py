@@ -1,3 +1,26 @@
 """A teeny CLI project manager"""
 
-from .teenypm import main, __version__, Entry, Event
+import sys
+
+def main():
+    # `pm status` is run from shell prompts, so skip importing rich, plugins etc.
+    if sys.argv[1:2] == ['status']:
+        from .status import main as status_main
+        sys.exit(status_main(sys.argv[2:]))
+
+    # likewise machine-readable listings stream straight from SQLite
+    if sys.argv[1:2] in (['show'], ['doing'], ['tags'], ['search']) and any(a.startswith('--format') for a in sys.argv[2:]):
+        from .export import main as export_main
+        code = export_main(sys.argv[1:])     # None when the full CLI is needed
+        if code is not None:
+            sys.exit(code)
+
+    from .teenypm import main as teenypm_main
+    teenypm_main()
+
+def __getattr__(name):
+    if name in ('__version__', 'Entry', 'Event'):
+        from . import teenypm
+        return getattr(teenypm, name)
+
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
@@ -0,0 +1,130 @@
+# Machine-readable listings (--format json|jsonl|tsv) - streams rows straight
+# from SQLite without importing rich or humanize
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+
+from .status import find_db
+from .schema import SCHEMA_VERSION
+
+FORMATS = ['json', 'jsonl', 'tsv']
+COMMANDS = ['show', 'doing', 'tags', 'search']
+
+ENTRY_FIELDS = ['id', 'state', 'points', 'remote_id', 'tags', 'created', 'done', 'deadline', 'msg']
+TAG_FIELDS = ['tag', 'count']
+
+ENTRIES_SQL = """
+    SELECT e.rowid AS id, e.state, e.points, e.remote_id,
+        (SELECT json_group_array(t.name) FROM entry_tag et JOIN tags t ON t.id = et.tag_id WHERE et.entry = e.rowid) AS tags,
+        (SELECT strftime('%Y-%m-%dT%H:%M:%SZ', MIN(h.date)) FROM history h WHERE h.entry = e.rowid AND h.event = 'create') AS created,
+        (SELECT strftime('%Y-%m-%dT%H:%M:%SZ', MAX(h.date)) FROM history h WHERE h.entry = e.rowid AND h.event = 'done') AS done,
+        strftime('%Y-%m-%dT%H:%M:%S', d.date) AS deadline,
+        e.msg
+    FROM entry e LEFT JOIN deadline d ON d.entry = e.rowid
+    WHERE (:all OR e.state != 'done')
+        AND (NOT :started OR e.state = 'doing')
+        AND (:id IS NULL OR e.rowid = :id)
+        AND (:text IS NULL OR e.msg LIKE '%' || :text || '%')
+        AND (:tags IS NULL OR e.rowid IN (SELECT et.entry FROM entry_tag et JOIN tags t ON t.id = et.tag_id WHERE t.name IN (SELECT value FROM json_each(:tags))))
+    ORDER BY CASE e.state WHEN 'doing' THEN 0 WHEN 'backlog' THEN 1 ELSE 2 END, e.rowid DESC
+"""
+
+TAGS_SQL = 'SELECT t.name AS tag, COUNT(*) AS count FROM entry_tag et JOIN tags t ON t.id = et.tag_id GROUP BY t.id ORDER BY t.name'
+
+def iter_entries(db, tags = None, all = False, started = False, id = None, text = None):
+    params = {
+        'all': all,
+        'started': started,
+        'id': id,
+        'text': text,
+        'tags': json.dumps(tags.split(',')) if tags else None
+    }
+
+    for row in db.execute(ENTRIES_SQL, params):
+        row = dict(row)
+        row['tags'] = json.loads(row['tags'])
+        yield row
+
+def iter_tags(db):
+    for row in db.execute(TAGS_SQL):
+        yield dict(row)
+
+def tsv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        value = ','.join(value)
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+def write_rows(rows, fields, fmt, out = sys.stdout):
+    if fmt == 'jsonl':
+        for row in rows:
+            out.write(json.dumps(row) + '\n')
+
+    elif fmt == 'json':
+        sep = '\n'
+        out.write('[')
+        for row in rows:
+            out.write(sep + json.dumps(row))
+            sep = ',\n'
+        out.write('\n]\n')
+
+    else:
+        out.write('\t'.join(fields) + '\n')
+        for row in rows:
+            out.write('\t'.join(tsv_value(row[f]) for f in fields) + '\n')
+
+def export(db, command, fmt, tags = None, all = False, text = None):
+    if command == 'tags':
+        write_rows(iter_tags(db), TAG_FIELDS, fmt)
+        return
+
+    id = None
+    if tags and ((tags.startswith('PM') and tags[2:].isdigit()) or tags.isdigit()):
+        id = int(tags[2:] if tags.startswith('PM') else tags)
+        tags = None
+        all = True
+
+    rows = iter_entries(db, tags, all, command == 'doing', id, text)
+    write_rows(rows, ENTRY_FIELDS, fmt)
+
+def main(args):
+    parser = argparse.ArgumentParser(prog='pm')
+    parser.add_argument('command', choices=COMMANDS)
+    parser.add_argument('tags', nargs='?', type=str)
+    parser.add_argument('-a', '--all', action='store_true')
+    parser.add_argument('-d', '--dates', action='store_true')
+    parser.add_argument('--format', choices=FORMATS, required=True)
+    args, unknown = parser.parse_known_intermixed_args(args)
+
+    # options like --archived or --watch are only understood by the full CLI
+    if unknown:
+        return None
+
+    filename = find_db()
+    if not os.path.isfile(filename):
+        return 1
+
+    text = None
+    if args.command == 'search':
+        text, args.tags = args.tags, None
+
+    db = sqlite3.connect('file:{}?mode=ro'.format(filename), uri=True)
+    db.row_factory = sqlite3.Row
+
+    # older databases need the migrations in init_db, so leave them to the full CLI
+    if db.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+        db.close()
+        return None
+
+    try:
+        export(db, args.command, args.format, args.tags, args.all, text)
+    except BrokenPipeError:
+        sys.stderr.close()
+    finally:
+        db.close()
+
+    return 0
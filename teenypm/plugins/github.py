@@ -4,15 +4,30 @@ import configparser
 import pprint
 import os
 import sys
+import time
+import hmac
+import hashlib
+import json as jsonlib
+import re
 import requests
 from pathlib import Path
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, urlunparse, parse_qs, urlencode, unquote
 from teenypm import Entry
 
 API_USER_KEY = 'github.api.user'
 API_REPO_KEY = 'github.api.repo'
+GRAPHQL_KEY = 'github.api.graphql'
 
 TOKEN_FILE = Path.home() / '.teenypm' / 'github.conf'
 
+API_URL = 'https://api.github.com'
+GRAPHQL_URL = API_URL + '/graphql'
+REQUEST_TIMEOUT = 30        # seconds - also bounds pm -s, which syncs outside the plugin timeout
+
+# live (default), record:<cassette>, replay:<cassette> or fake[:<latency ms>[:<state file>]]
+TRANSPORT_ENV = 'TEENYPM_GITHUB_TRANSPORT'
+
 def parse_git_config():
     info = {}
     if os.path.isfile('.git/config'):
@@ -47,6 +62,8 @@ def setup(config):
     config[API_USER_KEY] = quiet_input('Enter the GitHub user for API access', defaults.get('user', ''))
     api_token = quiet_input('Enter your GitHub access token', '')
     config[API_REPO_KEY] = quiet_input('Enter the GitHub repo', defaults.get('repo', ''))
+    if quiet_input('Batch changes using the GraphQL API (y/n)', 'n').lower().startswith('y'):
+        config[GRAPHQL_KEY] = 'true'
  
     project_id = config['project.id']
     TOKEN_FILE.parent.mkdir(parents=True, exist_ok=True)
@@ -58,6 +75,7 @@ def setup(config):
 def remove(config):
     config.pop(API_USER_KEY, None)
     config.pop(API_REPO_KEY, None)
+    config.pop(GRAPHQL_KEY, None)
 
     project_id = config['project.id']
     lines = []
@@ -72,7 +90,10 @@ def remove(config):
 
 def fetch_issues(config, tags = [], id = None):
     # FIXME: filter by tags / id
-    ghi = github_request(config, 'GET', '/repos/{owner}/{repo}/issues')
+    if use_graphql(config):
+        return graphql_fetch_issues(config)
+
+    ghi = github_paged_request(config, '/repos/{owner}/{repo}/issues')
     if ghi == None:
         return []
 
@@ -81,23 +102,26 @@ def fetch_issues(config, tags = [], id = None):
         if 'pull_request' in issue:
             continue
 
-        remote_id = str(issue['number'])
-        msg = issue['title']
-        if issue['body'] != '':
-            msg = '{}\n\n{}'.format(issue['title'], issue['body'])
+        labels = [label['name'] for label in issue['labels']]
+        issues.append(make_entry(issue['number'], issue['title'], issue['body'], labels, issue['state']))
+
+    return issues
 
-        tags = [label['name'] for label in issue['labels']]
-        if len(tags) == 0:
-            tags.append('task')
+def make_entry(number, title, body, labels, state):
+    msg = title
+    if body:
+        msg = '{}\n\n{}'.format(title, body)
 
-        if issue['state'] == 'closed':
-            state = 'done'
-        else:
-            state = 'backlog'
+    tags = list(labels)
+    if len(tags) == 0:
+        tags.append('task')
 
-        issues.append(Entry(None, state, msg, 1, remote_id, tags, [], None))
+    if state.lower() == 'closed':
+        state = 'done'
+    else:
+        state = 'backlog'
 
-    return issues
+    return Entry(None, state, msg, 1, str(number), tags, [], None)
 
 def add_entry(config, e):
     msg_parts = list(filter(lambda line: line != '', e.msg.split('\n')))
@@ -111,7 +135,7 @@ def add_entry(config, e):
         'labels': e.tags
     })
 
-    e.remote_id = remote_issue['number']
+    e.remote_id = str(remote_issue['number'])
 
 def update_entry(config, e, msg):
     msg_parts = list(filter(lambda line: line != '', msg.split('\n')))
@@ -119,6 +143,10 @@ def update_entry(config, e, msg):
     if len(msg_parts) > 1:
         body = msg_parts[1]
 
+    if use_graphql(config):
+        queue_change('update', e, { 'title': msg_parts[0], 'body': body })
+        return
+
     github_request(config, 'POST', '/repos/{owner}/{repo}/issues/' + e.remote_id, {
         'title': msg_parts[0],
         'body': body
@@ -129,11 +157,19 @@ def remove_entry(config, e):
     print('NOTE: Cannot delete the issue in GitHub - closed it instead')
 
 def tag_entry(config, e, tag):
+    if use_graphql(config):
+        queue_change('label', e, tag)
+        return
+
     github_request(config, 'POST', '/repos/{owner}/{repo}/issues/' + e.remote_id + '/labels', {
         'labels': [ tag ]
     })
 
 def untag_entry(config, e, tag):
+    if use_graphql(config):
+        queue_change('unlabel', e, tag)
+        return
+
     github_request(config, 'DELETE', '/repos/{owner}/{repo}/issues/' + e.remote_id + '/labels/' + tag)
 
 def add_feature(config, tag):
@@ -152,28 +188,485 @@ def backlog_entry(config, e):
     change_state(config, e, 'open')
 
 def change_state(config, e, state):
+    if use_graphql(config):
+        queue_change('update', e, { 'state': state.upper() })
+        return
+
     github_request(config, 'PATCH', '/repos/{owner}/{repo}/issues/' + e.remote_id, {
         'state': state
     })
 
+# webhooks - apply issue and label events pushed by GitHub to the local store
+
+def serve_webhook(config, local, port, secret):
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            signature = 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+            if not hmac.compare_digest(signature, self.headers.get('X-Hub-Signature-256', '')):
+                self.send_response(401)
+                self.end_headers()
+                return
+
+            try:
+                apply_event(config, local, self.headers.get('X-GitHub-Event', ''), jsonlib.loads(body))
+                self.send_response(204)
+            except Exception as ex:
+                print('Error applying webhook event - {}'.format(ex))
+                self.send_response(500)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', port), WebhookHandler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def apply_event(config, local, event, payload):
+    # GitHub owner and repository names are case-insensitive
+    repo = payload.get('repository', {}).get('full_name')
+    if (repo or '').lower() != '{}/{}'.format(config[API_USER_KEY], config[API_REPO_KEY]).lower():
+        print('Ignoring {} event for repository {}'.format(event, repo))
+        return
+
+    if event == 'label':
+        label = payload['label']['name']
+        if payload['action'] == 'edited' and 'name' in payload.get('changes', {}):
+            local.rename_tag(config, payload['changes']['name']['from'], label)
+        elif payload['action'] == 'deleted':
+            local.delete_tag(config, label)
+        return
+
+    if event != 'issues' or 'pull_request' in payload['issue']:
+        return
+
+    action = payload['action']
+    issue = payload['issue']
+    labels = [label['name'] for label in issue['labels']]
+    e = local.find_remote_entry(config, issue['number'])
+
+    if e == None:
+        if action != 'deleted':
+            e = make_entry(issue['number'], issue['title'], issue['body'], labels, issue['state'])
+            local.add_entry(config, e)
+            print('GitHub issue pulled: GH #{} - {}'.format(e.remote_id, e.summary()))
+        return
+
+    if action == 'edited':
+        local.update_entry(config, e, make_entry(issue['number'], issue['title'], issue['body'], labels, issue['state']).msg)
+    elif action == 'closed':
+        local.end_entry(config, e)
+    elif action == 'reopened':
+        local.backlog_entry(config, e)
+    elif action == 'deleted':
+        local.remove_entry(config, e)
+    elif action == 'labeled':
+        local.tag_entry(config, e, payload['label']['name'])
+    elif action == 'unlabeled':
+        local.untag_entry(config, e, payload['label']['name'])
+
+# GraphQL batching - changes are queued by the entry functions above and sent
+# as a single aliased mutation when flush() is called
+
+pending = []
+
+ISSUES_QUERY = """
+query($owner: String!, $repo: String!, $cursor: String) {
+  repository(owner: $owner, name: $repo) {
+    issues(first: 100, after: $cursor, states: OPEN, orderBy: {field: CREATED_AT, direction: DESC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes { number title body state labels(first: 100) { nodes { name } } }
+    }
+  }
+}
+"""
+
+MUTATION_TYPES = {
+    'update': ('updateIssue', 'UpdateIssueInput'),
+    'label': ('addLabelsToLabelable', 'AddLabelsToLabelableInput'),
+    'unlabel': ('removeLabelsFromLabelable', 'RemoveLabelsFromLabelableInput')
+}
+
+def use_graphql(config):
+    return config.get(GRAPHQL_KEY) == 'true'
+
+def queue_change(kind, e, arg):
+    if e.remote_id:
+        pending.append((kind, str(e.remote_id), arg))
+
+def graphql_fetch_issues(config):
+    issues = []
+    cursor = None
+
+    while True:
+        data = github_graphql(config, ISSUES_QUERY, { 'cursor': cursor })
+        if data == None:
+            return []
+
+        page = data['repository']['issues']
+        for issue in page['nodes']:
+            labels = [label['name'] for label in issue['labels']['nodes']]
+            issues.append(make_entry(issue['number'], issue['title'], issue['body'], labels, issue['state']))
+
+        if not page['pageInfo']['hasNextPage']:
+            return issues
+        cursor = page['pageInfo']['endCursor']
+
+def flush(config):
+    if len(pending) == 0:
+        return
+
+    changes = list(pending)
+    pending.clear()
+
+    # resolve issue numbers and label names to node ids in one query
+    numbers = sorted(set(int(number) for _, number, _ in changes))
+    labels = sorted(set(arg for kind, _, arg in changes if kind != 'update'))
+
+    params = ['$owner: String!', '$repo: String!'] + ['$l{}: String!'.format(i) for i in range(len(labels))]
+    fields = ['i{0}: issue(number: {0}) {{ id }}'.format(n) for n in numbers]
+    fields += ['l{0}: label(name: $l{0}) {{ id }}'.format(i) for i in range(len(labels))]
+
+    query = 'query({}) {{ repository(owner: $owner, name: $repo) {{ {} }} }}'.format(', '.join(params), ' '.join(fields))
+    data = github_graphql(config, query, {'l{}'.format(i): label for i, label in enumerate(labels)})
+    if data == None or data['repository'] == None:
+        return
+
+    repo = data['repository']
+    issue_ids = {str(n): repo['i{}'.format(n)]['id'] for n in numbers if repo['i{}'.format(n)]}
+    label_ids = {label: repo['l{}'.format(i)]['id'] for i, label in enumerate(labels) if repo['l{}'.format(i)]}
+
+    params = []
+    fields = []
+    variables = {}
+
+    for kind, number, arg in changes:
+        if number not in issue_ids:
+            continue
+
+        if kind == 'update':
+            input = dict(arg, id = issue_ids[number])
+        elif arg in label_ids:
+            input = { 'labelableId': issue_ids[number], 'labelIds': [label_ids[arg]] }
+        elif kind == 'label':
+            # labels that don't exist yet are created by the REST endpoint
+            github_request(config, 'POST', '/repos/{owner}/{repo}/issues/' + number + '/labels', { 'labels': [ arg ] })
+            continue
+        else:
+            continue
+
+        alias = 'm{}'.format(len(fields))
+        mutation, input_type = MUTATION_TYPES[kind]
+        params.append('${}: {}!'.format(alias, input_type))
+        fields.append('{0}: {1}(input: ${0}) {{ clientMutationId }}'.format(alias, mutation))
+        variables[alias] = input
+
+    if len(fields) > 0:
+        github_graphql(config, 'mutation({}) {{ {} }}'.format(', '.join(params), ' '.join(fields)), variables, repo_vars = False)
+
+def github_graphql(config, query, variables, repo_vars = True):
+    if repo_vars:
+        variables = dict(variables, owner = config[API_USER_KEY], repo = config[API_REPO_KEY])
+
+    result = github_response(config, 'POST', GRAPHQL_URL, { 'query': query, 'variables': variables })
+    if result == None:
+        return None
+
+    body = result.json()
+    for error in body.get('errors', []):
+        print('GitHub API error - {}'.format(error['message']))
+
+    return body.get('data')
+
 def github_request(config, method, path, data = None):
-    project_id = config['project.id']
- 
-    with TOKEN_FILE.open() as fh:
-        for line in fh:
-            if line.startswith(project_id):
-                api_token = line.rstrip().split('=')[1]
-                break
+    url = API_URL + path.format(owner = config[API_USER_KEY], repo = config[API_REPO_KEY])
+    result = github_response(config, method, url, data)
+    if result == None:
+        return None
+
+    return result.json()
+
+def github_paged_request(config, path):
+    url = API_URL + path.format(owner = config[API_USER_KEY], repo = config[API_REPO_KEY]) + '?per_page=100'
+    items = []
+
+    while url:
+        result = github_response(config, 'GET', url)
+        if result == None:
+            return None
+
+        items += result.json()
+        url = result.links.get('next', {}).get('url')
+
+    return items
+
+def github_response(config, method, url, data = None):
+    transport = get_transport()
+    api_token = None
 
-    if not api_token:
+    if TOKEN_FILE.is_file():
+        project_id = config['project.id']
+        with TOKEN_FILE.open() as fh:
+            for line in fh:
+                if line.startswith(project_id):
+                    api_token = line.rstrip().split('=')[1]
+                    break
+
+    if not api_token and isinstance(transport, LiveTransport):
         print('Error - no GitHub token configured')
         return None
 
-    url = 'https://api.github.com' + path.format(owner = config[API_USER_KEY], repo = config[API_REPO_KEY])
-    result = requests.request(method, url, auth=(config[API_USER_KEY], api_token), json = data)
+    result = transport.request(method, url, auth=(config[API_USER_KEY], api_token), json = data)
 
     if result.status_code >= 200 and result.status_code < 300:
-        return result.json()
+        return result
     else:
         print('GitHub API error - {}: {}'.format(result.status_code, result.json()['message']))
         return None
+
+# transports
+
+_transport = None
+
+def get_transport():
+    global _transport
+
+    if _transport == None:
+        mode, _, arg = os.getenv(TRANSPORT_ENV, 'live').partition(':')
+
+        if mode == 'record':
+            _transport = RecordTransport(arg)
+        elif mode == 'replay':
+            _transport = ReplayTransport(arg)
+        elif mode == 'fake':
+            latency, _, state_file = arg.partition(':')
+            _transport = FakeGitHub(latency = float(latency or 0) / 1000, state_file = state_file or None)
+        else:
+            _transport = LiveTransport()
+
+    return _transport
+
+def set_transport(transport):
+    global _transport
+    _transport = transport
+
+class Response:
+    def __init__(self, status_code, body, headers = None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = requests.structures.CaseInsensitiveDict(headers or {})
+        self.links = requests.utils.parse_header_links(self.headers['Link']) if 'Link' in self.headers else []
+        self.links = {link['rel']: link for link in self.links}
+
+    def json(self):
+        return self.body
+
+class LiveTransport:
+    def request(self, method, url, auth = None, json = None):
+        return requests.request(method, url, auth = auth, json = json, timeout = REQUEST_TIMEOUT)
+
+class RecordTransport:
+    def __init__(self, cassette, transport = None):
+        self.cassette = Path(cassette)
+        self.transport = transport or LiveTransport()
+        self.interactions = []
+
+    def request(self, method, url, auth = None, json = None):
+        result = self.transport.request(method, url, auth = auth, json = json)
+
+        try:
+            body = result.json()
+        except ValueError:
+            body = None
+
+        self.interactions.append({
+            'method': method,
+            'url': url,
+            'request': json,
+            'status': result.status_code,
+            'headers': {k: v for k, v in result.headers.items() if k.lower() == 'link' or k.lower().startswith('x-ratelimit')},
+            'response': body
+        })
+
+        with self.cassette.open('w') as fh:
+            jsonlib.dump({'interactions': self.interactions}, fh, indent = 2)
+
+        return Response(result.status_code, body, self.interactions[-1]['headers'])
+
+class ReplayTransport:
+    def __init__(self, cassette):
+        with Path(cassette).open() as fh:
+            self.interactions = jsonlib.load(fh)['interactions']
+
+    def request(self, method, url, auth = None, json = None):
+        for i, interaction in enumerate(self.interactions):
+            if interaction['method'] == method and interaction['url'] == url and interaction['request'] == json:
+                del self.interactions[i]
+                return Response(interaction['status'], interaction['response'], interaction['headers'])
+
+        return Response(404, {'message': 'no recorded interaction for {} {}'.format(method, url)})
+
+class FakeGitHub:
+    """In-process stand-in for the GitHub issues API, for offline testing and benchmarking.
+
+    Issues and labels are kept in state_file, if given, so that they carry
+    over between pm commands.
+    """
+
+    def __init__(self, latency = 0, per_page = 30, rate_limit = 5000, state_file = None):
+        self.latency = latency
+        self.per_page = per_page
+        self.rate_limit = rate_limit
+        self.remaining = rate_limit
+        self.issues = {}
+        self.labels = set()
+        self.requests = 0
+        self.state_file = Path(state_file) if state_file else None
+
+        if self.state_file and self.state_file.is_file():
+            with self.state_file.open() as fh:
+                state = jsonlib.load(fh)
+            self.issues = {issue['number']: issue for issue in state['issues']}
+            self.labels = set(state['labels'])
+
+    def save(self):
+        if self.state_file:
+            with self.state_file.open('w') as fh:
+                jsonlib.dump({'issues': list(self.issues.values()), 'labels': sorted(self.labels)}, fh, indent = 2)
+
+    def add_issue(self, title, body = '', labels = [], state = 'open'):
+        number = len(self.issues) + 1
+        self.issues[number] = {
+            'number': number,
+            'title': title,
+            'body': body,
+            'state': state,
+            'labels': [{'name': label} for label in labels]
+        }
+        self.labels.update(labels)
+        return self.issues[number]
+
+    def request(self, method, url, auth = None, json = None):
+        if self.latency:
+            time.sleep(self.latency)
+
+        self.requests += 1
+        headers = {
+            'X-RateLimit-Limit': str(self.rate_limit),
+            'X-RateLimit-Remaining': str(max(self.remaining - 1, 0)),
+            'X-RateLimit-Reset': str(int(time.time()) + 3600)
+        }
+
+        if self.remaining == 0:
+            return Response(403, {'message': 'API rate limit exceeded'}, headers)
+        self.remaining -= 1
+
+        response = self.respond(method, url, json, headers)
+        if method != 'GET':
+            self.save()
+        return response
+
+    def respond(self, method, url, json, headers):
+        parsed = urlparse(url)
+        query = parse_qs(parsed.query)
+
+        if parsed.path == '/graphql':
+            return self.graphql(json['query'], json['variables'], headers)
+
+        parts = parsed.path.strip('/').split('/')[3:]   # drop repos/{owner}/{repo}
+
+        if parts == ['issues'] and method == 'GET':
+            return self.list_issues(url, query, headers)
+
+        if parts == ['issues'] and method == 'POST':
+            issue = self.add_issue(json['title'], json.get('body', ''), json.get('labels', []))
+            return Response(201, issue, headers)
+
+        if len(parts) < 2 or not parts[1].isdigit() or int(parts[1]) not in self.issues:
+            return Response(404, {'message': 'Not Found'}, headers)
+
+        issue = self.issues[int(parts[1])]
+
+        if len(parts) == 2 and method in ('POST', 'PATCH'):
+            issue.update({k: v for k, v in json.items() if k in ('title', 'body', 'state')})
+            if 'labels' in json:
+                issue['labels'] = [{'name': label} for label in json['labels']]
+                self.labels.update(json['labels'])
+            return Response(200, issue, headers)
+
+        if len(parts) == 3 and parts[2] == 'labels' and method == 'POST':
+            names = [label['name'] for label in issue['labels']]
+            issue['labels'] += [{'name': label} for label in json['labels'] if label not in names]
+            self.labels.update(json['labels'])
+            return Response(200, issue['labels'], headers)
+
+        if len(parts) == 4 and parts[2] == 'labels' and method == 'DELETE':
+            issue['labels'] = [label for label in issue['labels'] if label['name'] != unquote(parts[3])]
+            return Response(200, issue['labels'], headers)
+
+        return Response(404, {'message': 'Not Found'}, headers)
+
+    def list_issues(self, url, query, headers):
+        state = query.get('state', ['open'])[0]
+        per_page = int(query.get('per_page', [self.per_page])[0])
+        page = int(query.get('page', ['1'])[0])
+
+        issues = [i for i in self.issues.values() if state == 'all' or i['state'] == state]
+        issues.sort(key = lambda i: -i['number'])
+
+        start = (page - 1) * per_page
+        if start + per_page < len(issues):
+            query['page'] = [str(page + 1)]
+            next_url = urlunparse(urlparse(url)._replace(query = urlencode(query, doseq = True)))
+            headers['Link'] = '<{}>; rel="next"'.format(next_url)
+
+        return Response(200, issues[start:start + per_page], headers)
+
+    def graphql(self, query, variables, headers):
+        # just enough GraphQL for the queries and mutations this plugin sends,
+        # with issues and labels identified by 'I_<number>' and 'L_<name>'
+        if 'issues(' in query:
+            issues = sorted((i for i in self.issues.values() if i['state'] == 'open'), key = lambda i: -i['number'])
+            start = int(variables.get('cursor') or 0)
+            nodes = [dict(i, state = i['state'].upper(), labels = {'nodes': i['labels']}) for i in issues[start:start + 100]]
+            page = {
+                'pageInfo': {'hasNextPage': start + 100 < len(issues), 'endCursor': str(start + 100)},
+                'nodes': nodes
+            }
+            return Response(200, {'data': {'repository': {'issues': page}}}, headers)
+
+        data = {}
+
+        for alias, number in re.findall(r'(i\d+): issue\(number: (\d+)\)', query):
+            data[alias] = {'id': 'I_' + number} if int(number) in self.issues else None
+
+        for alias, var in re.findall(r'(l\d+): label\(name: \$(l\d+)\)', query):
+            name = variables[var]
+            data[alias] = {'id': 'L_' + name} if name in self.labels else None
+
+        if not query.startswith('mutation'):
+            return Response(200, {'data': {'repository': data}}, headers)
+
+        for alias, mutation in re.findall(r'(m\d+): (\w+)\(input: \$m\d+\)', query):
+            input = variables[alias]
+            issue = self.issues[int(input.get('id', input.get('labelableId'))[2:])]
+
+            if mutation == 'updateIssue':
+                issue.update({k: v for k, v in input.items() if k in ('title', 'body')})
+                if 'state' in input:
+                    issue['state'] = input['state'].lower()
+            else:
+                names = [id[2:] for id in input['labelIds']]
+                issue['labels'] = [label for label in issue['labels'] if label['name'] not in names]
+                if mutation == 'addLabelsToLabelable':
+                    issue['labels'] += [{'name': name} for name in names]
+
+            data[alias] = {'clientMutationId': None}
+
+        return Response(200, {'data': data}, headers)
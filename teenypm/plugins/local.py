@@ -5,6 +5,8 @@ import pprint
 import os
 import sys
 import requests
+import uuid
+import json
 from datetime import datetime, timezone
 from teenypm import Entry, Event
 
@@ -31,98 +33,129 @@ def fetch_issues(config, tags = [], id = None):
     deadlines = {}
     entry_tags = {}
 
-    for row in c.execute('SELECT entry, GROUP_CONCAT(tag) as tags FROM tag GROUP BY entry'):
-        entry_tags[row['entry']] = row['tags'].split(',')
+    for row in c.execute('SELECT et.entry, t.name FROM entry_tag et JOIN tags t ON t.id = et.tag_id'):
+        entry_tags.setdefault(row['entry'], []).append(row['name'])
 
     for row in c.execute('SELECT entry, date as "date [timestamp]" FROM deadline'):
         deadlines[row['entry']] = row['date']
 
-    sql = 'SELECT rowid AS id, state, msg, points, remote_id FROM entry'
+    sql = 'SELECT rowid AS id, state, msg, points, remote_id, uuid FROM entry'
     if id:
         c.execute(sql + ' WHERE id = ?', (id,))
+    elif len(tags) > 0:
+        c.execute(sql + ' WHERE id IN (SELECT et.entry FROM entry_tag et JOIN tags t ON t.id = et.tag_id WHERE t.name IN (SELECT value FROM json_each(?)))', (json.dumps(tags.split(',')),))
     else:
         c.execute(sql)
 
-    for row in c:
+    for row in c.fetchall():
         etags = entry_tags.get(row['id'], [])
-
-        match = False
-        if len(tags) > 0:
-            for t in tags.split(','):
-                if t in etags:
-                    match = True
-                    break
-        else:
-            match = True
-
-        if match:
-            result.append(Entry(
-                row['id'], row['state'],
-                row['msg'], row['points'],
-                row['remote_id'], etags,
-                fetch_history(config.db, row['id']),
-                deadlines.get(row['id'], None)
-            ))
+        result.append(Entry(
+            row['id'], row['state'],
+            row['msg'], row['points'],
+            row['remote_id'], etags,
+            fetch_history(config.db, row['id']),
+            deadlines.get(row['id'], None),
+            row['uuid']
+        ))
 
     state_order = ['doing', 'backlog', 'done']
     return sorted(result, key=lambda e: (state_order.index(e.state), -e.id))
 
 def add_entry(config, e):
     c = config.db.cursor()
-    c.execute("INSERT INTO entry (msg, points, state, remote_id) VALUES (?, ?, ?, ?)", (e.msg, e.points, e.state, e.remote_id))
+    e.uuid = e.uuid or uuid.uuid4().hex
+    c.execute("INSERT INTO entry (msg, points, state, remote_id, uuid) VALUES (?, ?, ?, ?, ?)", (e.msg, e.points, e.state, e.remote_id, e.uuid))
 
     e.id = c.lastrowid
     add_history(c, e.id, 'create')
 
     for tag in e.tags:
-        c.execute('INSERT INTO tag VALUES (?, ?)', (tag, e.id))
+        c.execute('INSERT OR IGNORE INTO entry_tag (entry, tag_id) VALUES (?, ?)', (e.id, tag_id(c, tag)))
 
     config.db.commit()
 
 def update_entry(config, issue, msg):
     c = config.db.cursor()
     c.execute('UPDATE entry SET msg = ? WHERE rowid = ?', (msg, issue.id))
+    add_history(c, issue.id, 'edit')
     config.db.commit()
     issue.msg = msg
 
+def update_remote_id(config, e):
+    c = config.db.cursor()
+    c.execute('UPDATE entry SET remote_id = ? WHERE id = ?', (e.remote_id, e.id))
+    config.db.commit()
+
 def remove_entry(config, e):
     c = config.db.cursor()
-    c.execute('DELETE FROM tag where entry = ?', (e.id,))
+    c.execute('DELETE FROM entry_tag where entry = ?', (e.id,))
     c.execute('DELETE FROM entry where rowid = ?', (e.id,))
     config.db.commit()
 
 def tag_entry(config, e, tag):
     c = config.db.cursor()
-    count = c.execute('SELECT count(*) as count from tag where entry = ? and tag = ?', (e.id, tag)).fetchone()['count']
-    if count == 0:
-        c.execute('INSERT INTO tag VALUES (?, ?)', (tag, e.id))
-        config.db.commit()
+    c.execute('INSERT OR IGNORE INTO entry_tag (entry, tag_id) VALUES (?, ?)', (e.id, tag_id(c, tag)))
+    config.db.commit()
 
 def untag_entry(config, e, tag):
     c = config.db.cursor()
-    c.execute('DELETE FROM tag where tag = ? and entry = ?', (tag, e.id))
+    c.execute('DELETE FROM entry_tag where entry = ? and tag_id = (SELECT id FROM tags WHERE name = ?)', (e.id, tag))
     config.db.commit()
     return c.rowcount > 0
 
+def find_remote_entry(config, remote_id):
+    c = config.db.cursor()
+    row = c.execute('SELECT id FROM entry WHERE remote_id = ?', (str(remote_id),)).fetchone()
+    if row == None:
+        return None
+
+    return fetch_issues(config, [], row['id'])[0]
+
+def rename_tag(config, old, new):
+    c = config.db.cursor()
+    new_id = tag_id(c, new)
+    c.execute('UPDATE OR IGNORE entry_tag SET tag_id = ? WHERE tag_id = (SELECT id FROM tags WHERE name = ?)', (new_id, old))
+    c.execute('UPDATE tags SET is_feature = MAX(is_feature, IFNULL((SELECT is_feature FROM tags WHERE name = ?), 0)) WHERE id = ?', (old, new_id))
+    delete_tag(config, old)
+
+def delete_tag(config, tag):
+    c = config.db.cursor()
+    c.execute('DELETE FROM entry_tag WHERE tag_id = (SELECT id FROM tags WHERE name = ?)', (tag,))
+    c.execute('DELETE FROM tags WHERE name = ?', (tag,))
+    config.db.commit()
+
 def fetch_features(config):
     c = config.db.cursor()
-    features = []
-    for row in c.execute('SELECT tag FROM feature'):
-        features.append(row['tag'])
+    features = set()
+    for row in c.execute('SELECT name FROM tags WHERE is_feature'):
+        features.add(row['name'])
     return features
 
 def add_feature(config, tag):
     c = config.db.cursor()
-    count = c.execute('SELECT count(*) AS count FROM feature where tag = ?', (tag,)).fetchone()['count']
-    if count == 0:
-        c.execute('INSERT INTO feature VALUES (?)', (tag,))
+    c.execute('UPDATE tags SET is_feature = 1 WHERE id = ?', (tag_id(c, tag),))
     config.db.commit()
 
 def remove_feature(config, tag):
     c = config.db.cursor()
-    c.execute('DELETE FROM feature WHERE tag = ?', (tag,))
+    c.execute('UPDATE tags SET is_feature = 0 WHERE name = ?', (tag,))
     config.db.commit()
 
+def fetch_due(config, before):
+    c = config.db.cursor()
+    return c.execute("""
+        SELECT e.id, e.msg, d.date AS "date [timestamp]"
+        FROM deadline d JOIN entry e ON e.id = d.entry
+        WHERE d.date < ? AND e.state = 'doing'
+        ORDER BY d.date
+    """, (before,)).fetchall()
+
+def count_due(config, before):
+    c = config.db.cursor()
+    return c.execute("""
+        SELECT COUNT(*) FROM deadline d JOIN entry e ON e.id = d.entry WHERE d.date < ? AND e.state = 'doing'
+    """, (before,)).fetchone()[0]
+
 def start_entry(config, e, deadline = None):
     change_state(config, e, 'doing')
     if deadline:
@@ -139,11 +172,144 @@ def backlog_entry(config, e):
     change_state(config, e, 'backlog')
     clear_deadline(config, e.id)
 
+def fetch_stats(config, weeks = 8):
+    c = config.db.cursor()
+    stats = {}
+
+    # weeks are labelled by the date of their Monday, which unlike %W doesn't
+    # split a week that spans New Year
+    spans = """
+        spans AS (
+            SELECT h.entry, e.points,
+                MIN(CASE WHEN h.event = 'create' THEN julianday(h.date) END) AS created,
+                MIN(CASE WHEN h.event = 'doing' THEN julianday(h.date) END) AS started,
+                MAX(CASE WHEN h.event = 'done' THEN julianday(h.date) END) AS done
+            FROM history h JOIN entry e ON e.rowid = h.entry
+            WHERE e.state = 'done'
+            GROUP BY h.entry
+        )
+    """
+
+    row = c.execute("WITH " + spans + """,
+        ranked AS (
+            SELECT done - created AS lead, done - started AS cycle,
+                ROW_NUMBER() OVER (ORDER BY done - created) AS lead_rank,
+                ROW_NUMBER() OVER (ORDER BY done - started) AS cycle_rank,
+                COUNT(*) OVER () AS closed,
+                COUNT(started) OVER () AS cycled
+            FROM spans WHERE done IS NOT NULL
+        )
+        SELECT MAX(closed) AS closed, AVG(lead) AS lead_avg, AVG(cycle) AS cycle_avg,
+            MAX(CASE WHEN lead_rank = (closed + 1) / 2 THEN lead END) AS lead_median,
+            MAX(CASE WHEN cycle IS NOT NULL AND cycle_rank = (closed - cycled) + (cycled + 1) / 2 THEN cycle END) AS cycle_median
+        FROM ranked
+    """).fetchone()
+
+    stats['summary'] = {
+        'closed': row['closed'] or 0,
+        'lead_time_avg_days': row['lead_avg'],
+        'lead_time_median_days': row['lead_median'],
+        'cycle_time_avg_days': row['cycle_avg'],
+        'cycle_time_median_days': row['cycle_median']
+    }
+
+    stats['weekly'] = [dict(row) for row in c.execute("WITH RECURSIVE " + spans + """,
+        weeks (week, n) AS (
+            SELECT date('now', 'weekday 0', '-6 days'), 1
+            UNION ALL SELECT date(week, '-7 days'), n + 1 FROM weeks WHERE n < ?
+        ),
+        closed AS (
+            SELECT date(done, 'weekday 0', '-6 days') AS week, COUNT(*) AS closed, SUM(points) AS points
+            FROM spans WHERE done IS NOT NULL
+            GROUP BY 1
+        )
+        SELECT w.week, IFNULL(cl.closed, 0) AS closed, IFNULL(cl.points, 0) AS points
+        FROM weeks w LEFT JOIN closed cl ON cl.week = w.week
+        ORDER BY w.week DESC
+    """, (weeks,))]
+
+    stats['burndown'] = [dict(row) for row in c.execute("""
+        WITH ft AS (
+            SELECT t.name AS tag, et.entry, e.points, e.state
+            FROM entry_tag et JOIN tags t ON t.id = et.tag_id AND t.is_feature JOIN entry e ON e.rowid = et.entry
+        ),
+        totals AS (
+            SELECT tag, SUM(points) AS total FROM ft GROUP BY tag
+        ),
+        burned AS (
+            SELECT ft.tag, date(MAX(h.date), 'weekday 0', '-6 days') AS week, ft.points
+            FROM ft JOIN history h ON h.entry = ft.entry AND h.event = 'done'
+            WHERE ft.state = 'done'
+            GROUP BY ft.tag, ft.entry
+        ),
+        weekly AS (
+            SELECT tag, week, SUM(points) AS points FROM burned GROUP BY tag, week
+        )
+        SELECT w.tag, w.week, w.points, t.total,
+            t.total - SUM(w.points) OVER (PARTITION BY w.tag ORDER BY w.week) AS remaining
+        FROM weekly w JOIN totals t ON t.tag = w.tag
+        ORDER BY w.tag, w.week
+    """)]
+
+    return stats
+
+def archive_entries(config, archive_file, days):
+    c = config.db.cursor()
+    c.execute('ATTACH DATABASE ? AS archive', (archive_file,))
+
+    try:
+        c.execute('DROP TABLE IF EXISTS temp.archiving')
+        c.execute("""
+            CREATE TEMP TABLE archiving AS
+            SELECT e.rowid AS id FROM main.entry e
+            WHERE e.state = 'done'
+                AND (SELECT MAX(h.date) FROM main.history h WHERE h.entry = e.rowid AND h.event = 'done') < datetime('now', ?)
+        """, ('-{} days'.format(days),))
+
+        c.execute('INSERT INTO archive.entry (rowid, msg, points, state, remote_id, uuid) SELECT rowid, msg, points, state, remote_id, uuid FROM main.entry WHERE rowid IN temp.archiving')
+        # tag ids are local to each database, so map them across by name
+        c.execute('INSERT INTO archive.tags (name) SELECT name FROM main.tags EXCEPT SELECT name FROM archive.tags')
+        c.execute('UPDATE archive.tags SET is_feature = (SELECT is_feature FROM main.tags m WHERE m.name = tags.name) WHERE name IN (SELECT name FROM main.tags)')
+        c.execute("""
+            INSERT OR IGNORE INTO archive.entry_tag (entry, tag_id)
+            SELECT et.entry, at.id FROM main.entry_tag et JOIN main.tags mt ON mt.id = et.tag_id JOIN archive.tags at ON at.name = mt.name
+            WHERE et.entry IN temp.archiving
+        """)
+
+        for table in ['history', 'deadline']:
+            c.execute('INSERT INTO archive.{0} SELECT * FROM main.{0} WHERE entry IN temp.archiving'.format(table))
+
+        for table in ['entry_tag', 'history', 'deadline']:
+            c.execute('DELETE FROM main.{} WHERE entry IN temp.archiving'.format(table))
+        c.execute('DELETE FROM main.entry WHERE rowid IN temp.archiving')
+
+        count = c.execute('SELECT COUNT(*) AS count FROM temp.archiving').fetchone()['count']
+        c.execute('DROP TABLE temp.archiving')
+        config.db.commit()
+    except:
+        config.db.rollback()
+        raise
+    finally:
+        c.execute('DETACH DATABASE archive')
+
+    return count
+
+def vacuum(config):
+    c = config.db.cursor()
+    config.db.commit()
+    c.execute('VACUUM')
+    c.execute('ANALYZE')
+    c.execute('PRAGMA optimize')
+
 # internal
 
 def add_history(c, id, event):
     c.execute('INSERT INTO history (entry, date, event) VALUES (?, CURRENT_TIMESTAMP, ?)', (id, event))
 
+def tag_id(c, tag):
+    c.execute('INSERT OR IGNORE INTO tags (name) VALUES (?)', (tag,))
+    return c.execute('SELECT id FROM tags WHERE name = ?', (tag,)).fetchone()['id']
+
 def change_state(config, e, state):
     c = config.db.cursor()
     c.execute('UPDATE entry SET state = ? where rowid = ?', (state, e.id))
@@ -0,0 +1,271 @@
+# Sync issues with another teenypm database (e.g. on a network drive)
+
+import os
+import sys
+import sqlite3
+from contextlib import contextmanager
+from teenypm.teenypm import init_db, db_filename, Config
+
+PATH_KEY = 'sqlite.path'
+
+# each database's contents as of the last sync, so that a side which no longer
+# has something is known to have removed it rather than never to have had it
+SNAPSHOT_TABLES = {
+    'peer_synced': '(uuid TEXT PRIMARY KEY, state TEXT, msg TEXT, points INT)',
+    'peer_synced_tag': '(uuid TEXT, tag TEXT, PRIMARY KEY (uuid, tag))',
+    'peer_synced_feature': '(name TEXT PRIMARY KEY)'
+}
+
+def setup(config):
+    try:
+        path = input('Enter the path of the pm.db to sync with: ')
+    except KeyboardInterrupt:
+        print('\nExiting remote setup')
+        sys.exit(0)
+
+    if path == '':
+        print('Cancelled sqlite setup')
+        sys.exit(0)
+
+    path = os.path.abspath(os.path.expanduser(path))
+    created = not os.path.isfile(path)
+
+    try:
+        peer_db = init_db(path)
+    except sqlite3.OperationalError as ex:
+        print('Error - unable to open {} - {}'.format(path, ex))
+        return False
+
+    peer_config = Config(peer_db)
+
+    if created or peer_db.execute('SELECT COUNT(*) FROM entry').fetchone()[0] == 0:
+        peer_config['project.id'] = config['project.id']
+
+    peer_id = peer_config['project.id']
+    peer_db.close()
+
+    if peer_id != config['project.id']:
+        print('Error - {} belongs to a different project ({})'.format(path, peer_id))
+        return False
+
+    config[PATH_KEY] = path
+    return True
+
+def remove(config):
+    config.pop(PATH_KEY, None)
+    for table in SNAPSHOT_TABLES:
+        config.db.execute('DROP TABLE IF EXISTS {}'.format(table))
+
+def fetch_issues(config, tags = [], id = None):
+    return []
+
+def sync(config):
+    config.db.commit()
+    sync_files(db_filename(config.db), config[PATH_KEY], config['project.id'])
+
+# every change, removals included, is pushed in one reconcile at the end of
+# each command. Operations only note what to sync, as they run on the event
+# loop's thread, and flush runs off it on a connection of its own
+
+pending = None
+
+async def add_entry(config, e):
+    mark_dirty(config)
+
+async def update_entry(config, e, msg):
+    mark_dirty(config)
+
+async def start_entry(config, e, deadline = None):
+    mark_dirty(config)
+
+async def end_entry(config, e):
+    mark_dirty(config)
+
+async def backlog_entry(config, e):
+    mark_dirty(config)
+
+async def tag_entry(config, e, tag):
+    mark_dirty(config)
+
+async def untag_entry(config, e, tag):
+    mark_dirty(config)
+
+async def add_feature(config, tag):
+    mark_dirty(config)
+
+async def remove_feature(config, tag):
+    mark_dirty(config)
+
+async def remove_entry(config, e):
+    mark_dirty(config)
+
+def flush(config):
+    global pending
+
+    if pending:
+        args, pending = pending, None
+        sync_files(*args)
+
+def mark_dirty(config):
+    global pending
+    pending = (db_filename(config.db), config[PATH_KEY], config['project.id'])
+
+# internal
+
+def sync_files(filename, path, project_id):
+    # checked first, as attaching a missing file would create an empty one
+    if not os.path.isfile(path):
+        print('Error - sqlite remote {} not found'.format(path))
+        return
+
+    # bring the peer's schema up to date before attaching it
+    init_db(path).close()
+
+    with attached(filename, path) as c:
+        peer_id = c.execute("SELECT value FROM peer.config WHERE key = 'project.id'").fetchone()
+        if peer_id == None or peer_id[0] != project_id:
+            print('Error - {} belongs to a different project'.format(path))
+            return
+
+        for table, columns in SNAPSHOT_TABLES.items():
+            c.execute('CREATE TABLE IF NOT EXISTS main.{} {}'.format(table, columns))
+
+        reconcile(c)
+
+@contextmanager
+def attached(filename, path):
+    db = sqlite3.connect(filename)
+    c = db.cursor()
+    c.execute('ATTACH DATABASE ? AS peer', (path,))
+
+    try:
+        yield c
+        db.commit()
+    except:
+        db.rollback()
+        raise
+    finally:
+        c.execute('DETACH DATABASE peer')
+        db.close()
+
+def reconcile(c):
+    # anything in the snapshot that one side no longer has was removed (or
+    # archived) there since the last sync, so remove it from the other too
+    for side, other in [('main', 'peer'), ('peer', 'main')]:
+        fields = {'side': side, 'other': other}
+
+        c.execute("""
+            DELETE FROM {other}.entry_tag WHERE (entry, tag_id) IN (
+                SELECT oe.id, ot.id FROM main.peer_synced_tag s
+                    JOIN {other}.entry oe ON oe.uuid = s.uuid JOIN {other}.tags ot ON ot.name = s.tag
+                    JOIN {side}.entry se ON se.uuid = s.uuid
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {side}.entry_tag et JOIN {side}.tags st ON st.id = et.tag_id WHERE et.entry = se.id AND st.name = s.tag
+                )
+            )
+        """.format(**fields))
+
+        c.execute("""
+            UPDATE {other}.tags SET is_feature = 0
+            WHERE is_feature AND name IN (SELECT name FROM main.peer_synced_feature)
+                AND name NOT IN (SELECT name FROM {side}.tags WHERE is_feature)
+        """.format(**fields))
+
+        c.execute('DROP TABLE IF EXISTS temp.removed')
+        c.execute("""
+            CREATE TEMP TABLE removed AS
+            SELECT id FROM {other}.entry
+            WHERE uuid IN (SELECT uuid FROM main.peer_synced) AND uuid NOT IN (SELECT uuid FROM {side}.entry)
+        """.format(**fields))
+
+        for table in ['entry_tag', 'history', 'deadline']:
+            c.execute('DELETE FROM {}.{} WHERE entry IN temp.removed'.format(other, table))
+        c.execute('DELETE FROM {}.entry WHERE id IN temp.removed'.format(other))
+
+        c.execute('DROP TABLE temp.removed')
+
+    # main.peer_synced holds each entry as it was after the last sync: a side that
+    # still matches it is out of date, and only entries changed on both sides
+    # fall back to the most recent history event
+    c.execute('DROP TABLE IF EXISTS temp.changed')
+    c.execute("""
+        CREATE TEMP TABLE changed AS
+        SELECT me.id AS main_id, pe.id AS peer_id,
+            CASE
+                WHEN me.state IS s.state AND me.msg IS s.msg AND me.points IS s.points THEN 0
+                WHEN pe.state IS s.state AND pe.msg IS s.msg AND pe.points IS s.points THEN 1
+                ELSE IFNULL((SELECT MAX(date) FROM main.history WHERE entry = me.id), '') >= IFNULL((SELECT MAX(date) FROM peer.history WHERE entry = pe.id), '')
+            END AS main_newer
+        FROM main.entry me JOIN peer.entry pe ON pe.uuid = me.uuid LEFT JOIN main.peer_synced s ON s.uuid = me.uuid
+        WHERE me.state IS NOT pe.state OR me.msg IS NOT pe.msg OR me.points IS NOT pe.points
+    """)
+
+    for dst, src, dst_id, src_id, newer in [('main', 'peer', 'main_id', 'peer_id', 'NOT main_newer'), ('peer', 'main', 'peer_id', 'main_id', 'main_newer')]:
+        fields = {'dst': dst, 'src': src, 'dst_id': dst_id, 'src_id': src_id, 'newer': newer}
+
+        c.execute("""
+            UPDATE {dst}.entry SET (state, msg, points) = (
+                SELECT s.state, s.msg, s.points FROM {src}.entry s JOIN temp.changed ch ON ch.{src_id} = s.id WHERE ch.{dst_id} = entry.id
+            )
+            WHERE id IN (SELECT {dst_id} FROM temp.changed WHERE {newer})
+        """.format(**fields))
+
+        c.execute("""
+            DELETE FROM {dst}.deadline WHERE entry IN (SELECT {dst_id} FROM temp.changed WHERE {newer})
+        """.format(**fields))
+        c.execute("""
+            INSERT INTO {dst}.deadline (entry, date)
+            SELECT ch.{dst_id}, d.date FROM {src}.deadline d JOIN temp.changed ch ON ch.{src_id} = d.entry WHERE {newer}
+        """.format(**fields))
+
+    c.execute('DROP TABLE temp.changed')
+
+    # then copy across anything one side has that the other doesn't
+    for dst, src in [('main', 'peer'), ('peer', 'main')]:
+        fields = {'dst': dst, 'src': src}
+
+        c.execute("""
+            INSERT INTO {dst}.entry (msg, points, state, remote_id, uuid)
+            SELECT msg, points, state, remote_id, uuid FROM {src}.entry WHERE uuid NOT IN (SELECT uuid FROM {dst}.entry)
+        """.format(**fields))
+
+        # tag ids are local to each database, so tags are matched by name
+        c.execute("""
+            INSERT INTO {dst}.tags (name, is_feature)
+            SELECT name, is_feature FROM {src}.tags WHERE name NOT IN (SELECT name FROM {dst}.tags)
+        """.format(**fields))
+
+        c.execute("""
+            INSERT INTO {dst}.entry_tag (entry, tag_id)
+            SELECT de.id, dt.id FROM {src}.entry_tag et
+                JOIN {src}.entry se ON se.id = et.entry JOIN {dst}.entry de ON de.uuid = se.uuid
+                JOIN {src}.tags st ON st.id = et.tag_id JOIN {dst}.tags dt ON dt.name = st.name
+            EXCEPT SELECT entry, tag_id FROM {dst}.entry_tag
+        """.format(**fields))
+
+        c.execute("""
+            INSERT INTO {dst}.history (entry, event, date)
+            SELECT de.id, h.event, h.date FROM {src}.history h JOIN {src}.entry se ON se.id = h.entry JOIN {dst}.entry de ON de.uuid = se.uuid
+            EXCEPT SELECT entry, event, date FROM {dst}.history
+        """.format(**fields))
+
+        c.execute("""
+            INSERT INTO {dst}.deadline (entry, date)
+            SELECT de.id, d.date FROM {src}.deadline d JOIN {src}.entry se ON se.id = d.entry JOIN {dst}.entry de ON de.uuid = se.uuid
+            WHERE de.id NOT IN (SELECT entry FROM {dst}.deadline)
+        """.format(**fields))
+
+        c.execute("""
+            UPDATE {dst}.tags SET is_feature = 1 WHERE NOT is_feature AND name IN (SELECT name FROM {src}.tags WHERE is_feature)
+        """.format(**fields))
+
+    # both sides now agree, so either will do for the snapshot
+    for table in SNAPSHOT_TABLES:
+        c.execute('DELETE FROM main.{}'.format(table))
+
+    c.execute('INSERT INTO main.peer_synced (uuid, state, msg, points) SELECT uuid, state, msg, points FROM main.entry')
+    c.execute("""
+        INSERT INTO main.peer_synced_tag (uuid, tag)
+        SELECT e.uuid, t.name FROM main.entry_tag et JOIN main.entry e ON e.id = et.entry JOIN main.tags t ON t.id = et.tag_id
+    """)
+    c.execute('INSERT INTO main.peer_synced_feature (name) SELECT name FROM main.tags WHERE is_feature')
@@ -0,0 +1,73 @@
+# Database migrations - standard library only, so the status and export fast
+# paths can check a database's schema version without importing the rest of teenypm
+
+import uuid
+
+def create_tables(c):
+    c.execute('CREATE TABLE IF NOT EXISTS entry (msg TEXT, points INT, state TEXT)')
+    c.execute('CREATE TABLE IF NOT EXISTS tag (tag TEXT, entry INT)')
+    c.execute('CREATE TABLE IF NOT EXISTS history (entry INT, event TEXT, date INT)')
+    c.execute('CREATE TABLE IF NOT EXISTS feature (tag TEXT)')
+    c.execute('CREATE TABLE IF NOT EXISTS deadline (entry INT, date INT)')
+    c.execute('CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT)')
+
+def add_remote_id(c):
+    c.execute('ALTER TABLE entry ADD COLUMN remote_id TEXT')
+
+def add_project_id(c):
+    c.execute('INSERT INTO config (key, value) VALUES(?, ?)', ('project.id', str(uuid.uuid4())))
+
+def add_entry_key(c):
+    # give entry an explicit key so ids survive VACUUM and are never reused
+    c.execute('CREATE TABLE entry_v4 (id INTEGER PRIMARY KEY AUTOINCREMENT, msg TEXT, points INT, state TEXT, remote_id TEXT)')
+    c.execute('INSERT INTO entry_v4 (id, msg, points, state, remote_id) SELECT rowid, msg, points, state, remote_id FROM entry')
+    c.execute('DROP TABLE entry')
+    c.execute('ALTER TABLE entry_v4 RENAME TO entry')
+
+def add_listing_indexes(c):
+    c.execute('CREATE INDEX IF NOT EXISTS deadline_date ON deadline (date, entry)')
+    c.execute('CREATE INDEX IF NOT EXISTS entry_state ON entry (state)')
+
+def add_entry_uuid(c):
+    # stable identity for entries shared between databases
+    c.execute('ALTER TABLE entry ADD COLUMN uuid TEXT')
+    c.execute('UPDATE entry SET uuid = lower(hex(randomblob(16)))')
+    c.execute('CREATE UNIQUE INDEX entry_uuid ON entry (uuid)')
+
+def intern_tags(c):
+    # intern tag names, replacing the tag and feature tables
+    c.execute('CREATE TABLE tags (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, is_feature INT NOT NULL DEFAULT 0)')
+    c.execute('CREATE TABLE entry_tag (entry INT, tag_id INT, PRIMARY KEY (entry, tag_id)) WITHOUT ROWID')
+    c.execute('CREATE INDEX entry_tag_tag ON entry_tag (tag_id, entry)')
+    c.execute('INSERT INTO tags (name) SELECT tag FROM tag WHERE tag IS NOT NULL UNION SELECT tag FROM feature WHERE tag IS NOT NULL')
+    c.execute('UPDATE tags SET is_feature = 1 WHERE name IN (SELECT tag FROM feature)')
+    c.execute('INSERT OR IGNORE INTO entry_tag (entry, tag_id) SELECT t.entry, tags.id FROM tag t JOIN tags ON tags.name = t.tag')
+    c.execute('DROP TABLE tag')
+    c.execute('DROP TABLE feature')
+
+def add_history_index(c):
+    # per-entry history lookups (created/done dates) for listings and exports
+    c.execute('CREATE INDEX IF NOT EXISTS history_entry ON history (entry, event, date)')
+
+# MIGRATIONS[n] takes a database from user_version n to n + 1 - add new steps
+# to the end, never change or reorder existing ones
+MIGRATIONS = [
+    create_tables,
+    add_remote_id,
+    add_project_id,
+    add_entry_key,
+    add_listing_indexes,
+    add_entry_uuid,
+    intern_tags,
+    add_history_index
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def migrate(c):
+    version = c.execute('PRAGMA user_version').fetchone()[0]
+
+    for step in MIGRATIONS[version:]:
+        step(c)
+        version += 1
+        c.execute('PRAGMA user_version = {}'.format(version))
@@ -0,0 +1,69 @@
+# Fast path for `pm status` - deliberately imports nothing beyond the standard
+# library so it can be run from a shell prompt on every keypress
+
+import os
+import sqlite3
+import sys
+from datetime import datetime
+
+DB_FILE = 'pm.db'
+
+DEFAULT_FORMAT = '{doing} doing / {open} open / {overdue} overdue'
+
+# both queries are answered from the entry_state index alone
+STATE_COUNTS_SQL = 'SELECT state, COUNT(*) FROM entry GROUP BY state'
+
+OVERDUE_SQL = """
+    SELECT COUNT(*) FROM deadline d JOIN entry e ON e.rowid = d.entry WHERE e.state = 'doing' AND d.date < ?
+"""
+
+def find_db():
+    path = os.getcwd()
+    while True:
+        filename = os.path.join(path, DB_FILE)
+        if os.path.isfile(filename):
+            return filename
+
+        parent = os.path.dirname(path)
+        if parent == path:
+            return DB_FILE
+        path = parent
+
+def fetch_status(filename):
+    db = sqlite3.connect('file:{}?mode=ro'.format(filename), uri=True)
+
+    try:
+        counts = dict(db.execute(STATE_COUNTS_SQL).fetchall())
+        overdue = db.execute(OVERDUE_SQL, (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),)).fetchone()[0]
+    finally:
+        db.close()
+
+    total = sum(counts.values())
+    return {
+        'total': total,
+        'doing': counts.get('doing', 0),
+        'backlog': counts.get('backlog', 0),
+        'open': total - counts.get('done', 0),
+        'done': counts.get('done', 0),
+        'overdue': overdue
+    }
+
+def status(fmt = DEFAULT_FORMAT):
+    filename = find_db()
+    if not os.path.isfile(filename):
+        return 1
+
+    print(fmt.format(**fetch_status(filename)))
+    return 0
+
+def main(args):
+    fmt = DEFAULT_FORMAT
+
+    if args[:1] in (['-h'], ['--help']):
+        print('usage: pm status [-f FORMAT]\n\nFORMAT may use {total}, {doing}, {backlog}, {open}, {done} and {overdue}')
+        return 0
+
+    if args[:1] in (['-f'], ['--format']) and len(args) > 1:
+        fmt = args[1]
+
+    return status(fmt)
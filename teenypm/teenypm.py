@@ -12,10 +12,21 @@ import humanize
 import argparse
 import importlib.util
 from collections.abc import MutableMapping
-import uuid
+import json
+import asyncio
+import threading
+import hashlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from .status import find_db, DB_FILE, DEFAULT_FORMAT, status
+from .schema import migrate, SCHEMA_VERSION
+from . import export
 
 from rich import box
-from rich.console import Console
+from rich.console import Console, Group
+from rich.live import Live
+from rich.text import Text
 from rich.table import Table, Column
 from rich.style import Style
 from rich.theme import Theme
@@ -23,12 +34,20 @@ from rich.theme import Theme
 __version__ = '0.1.8'
 
 DEFAULT_EDITOR = 'vi +<line>'
+ARCHIVE_DB = 'pm.archive.db'
+REGISTRY_FILE = Path.home() / '.teenypm' / 'projects.conf'
+CACHE_DIR = Path.home() / '.teenypm' / 'cache'
+PLUGIN_TIMEOUT = 30
+WATCH_TICK = 30
+WEBHOOK_SECRET_ENV = 'TEENYPM_WEBHOOK_SECRET'
+BACKUP_PAGES = 64           # pages copied per backup step, between which writers can get in
 
 active_plugins = []
 
 class Entry:
-    def __init__(self, id, state, msg, points, remote_id, tags, history, deadline):
+    def __init__(self, id, state, msg, points, remote_id, tags, history, deadline, uuid = None):
         self.id = id
+        self.uuid = uuid
         self.state = state
         self.open = state != 'done'
         self.msg = msg
@@ -37,6 +56,7 @@ class Entry:
         self.tags = tags
         self.history = history
         self.deadline = deadline
+        self.project = None
 
         for e in history:
             if e.event == 'create':
@@ -72,7 +92,7 @@ class Config(MutableMapping):
         self.db = db
         c = db.cursor()
         for row in c.execute('SELECT key, value FROM config'):
-            self[row['key']] = row['value']
+            self.storage[row['key']] = row['value']
 
     def __getitem__(self, key):
         return self.storage[key]
@@ -105,81 +125,172 @@ class TeenyPM():
     def add_entry(self, tags, msg, points):
         e = Entry(None, 'backlog', msg, points, None, tags, [], None)
 
-        for p in reversed(active_plugins):
-            p.add_entry(self.config, e)
+        self.update_plugins('add_entry', e)
+        if e.remote_id:
+            active_plugins[0].update_remote_id(self.config, e)
 
         return e
 
     def edit_entry(self, issue, msg):
-        for p in reversed(active_plugins):
-            id = p.update_entry(self.config, issue, msg)
+        self.update_plugins('update_entry', issue, msg)
 
     def feature_tag(self, tag):
-        for p in reversed(active_plugins):
-            id = p.add_feature(self.config, tag)
+        self.update_plugins('add_feature', tag)
 
     def unfeature_tag(self, tag):
-        for p in reversed(active_plugins):
-            id = p.remove_feature(self.config, tag)
+        self.update_plugins('remove_feature', tag)
 
     def start_entry(self, issue, deadline = None):
-        for p in reversed(active_plugins):
-            p.start_entry(self.config, issue, deadline)
+        self.update_plugins('start_entry', issue, deadline)
 
     def end_entry(self, issue):
-        for p in reversed(active_plugins):
-            p.end_entry(self.config, issue)
+        self.update_plugins('end_entry', issue)
 
     def backlog_entry(self, issue):
-        for p in reversed(active_plugins):
-            p.backlog_entry(self.config, issue)
+        self.update_plugins('backlog_entry', issue)
 
     def tag_entry(self, issue, tag):
-        for p in reversed(active_plugins):
-            p.tag_entry(self.config, issue, tag)
+        self.update_plugins('tag_entry', issue, tag)
 
     def untag_entry(self, issue, tag):
-        for p in reversed(active_plugins):
-            p.untag_entry(self.config, issue, tag)
+        self.update_plugins('untag_entry', issue, tag)
 
     def remove_entry(self, issue):
-        for p in reversed(active_plugins):
-            p.remove_entry(self.config, issue)
+        self.update_plugins('remove_entry', issue)
+
+    def flush(self):
+        remotes = [p for p in active_plugins[1:] if hasattr(p, 'flush')]
+        if remotes:
+            asyncio.run(self.call_remotes(remotes, 'flush', ()))
+
+    def update_plugins(self, method, *args):
+        # the local store is always updated first, then all remotes concurrently
+        getattr(active_plugins[0], method)(self.config, *args)
+
+        remotes = active_plugins[1:]
+        if remotes:
+            asyncio.run(self.call_remotes(remotes, method, args))
+
+    async def call_remotes(self, remotes, method, args):
+        await asyncio.gather(*[self.call_remote(p, method, args) for p in remotes])
 
-def init_db():
-    filename = 'pm.db'
+    async def call_remote(self, plugin, method, args):
+        # plugins may implement any operation as either a plain or an async function
+        fn = getattr(plugin, method)
+        name = plugin.__name__.split('.')[-1]
+
+        if asyncio.iscoroutinefunction(fn):
+            call = fn(self.config, *args)
+        else:
+            call = run_in_daemon(lambda: fn(self.config, *args))
+
+        # add_entry may assign the entry a remote id, and giving up on it would
+        # lose that id and push the entry again on the next sync, so it's left
+        # to the plugin's own request timeouts
+        timeout = None if method == 'add_entry' else getattr(plugin, 'TIMEOUT', PLUGIN_TIMEOUT)
+
+        try:
+            await asyncio.wait_for(call, timeout)
+        except asyncio.TimeoutError:
+            print('Remote {} timed out during {}'.format(name, method))
+        except Exception as ex:
+            print('Remote {} failed during {}: {}'.format(name, method, ex))
+
+def run_in_daemon(fn):
+    # unlike executor workers, daemon threads aren't joined at exit, so a plugin
+    # that overran its timeout can't keep pm from exiting
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(result, ex):
+        if future.done():
+            return
+        if ex:
+            future.set_exception(ex)
+        else:
+            future.set_result(result)
+
+    def run():
+        try:
+            result, ex = fn(), None
+        except Exception as e:
+            result, ex = None, e
+
+        try:
+            loop.call_soon_threadsafe(resolve, result, ex)
+        except RuntimeError:
+            pass    # the loop has already gone, having given up on us
+
+    threading.Thread(target = run, daemon = True).start()
+    return future
+
+def read_registry():
+    projects = {}
+    if REGISTRY_FILE.is_file():
+        with REGISTRY_FILE.open() as fh:
+            for line in fh:
+                if '=' in line:
+                    id, filename = line.rstrip('\n').split('=', 1)
+                    projects[id] = filename
+
+    return projects
+
+def write_registry(projects):
+    REGISTRY_FILE.parent.mkdir(parents=True, exist_ok=True)
+    with REGISTRY_FILE.open('w') as fh:
+        fh.writelines('{}={}\n'.format(id, filename) for id, filename in projects.items())
+
+def init_db(filename = DB_FILE):
     if not os.path.isfile(filename):
         print('No teenypm database found - creating new one: ' + filename)
 
     db = sqlite3.connect(filename, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
     db.row_factory = sqlite3.Row
 
-    c = db.cursor()
-    schema_version = c.execute('PRAGMA user_version').fetchone()[0]
-
-    if schema_version == 0:
-        c.execute('CREATE TABLE IF NOT EXISTS entry (msg TEXT, points INT, state TEXT)')
-        c.execute('CREATE TABLE IF NOT EXISTS tag (tag TEXT, entry INT)')
-        c.execute('CREATE TABLE IF NOT EXISTS history (entry INT, event TEXT, date INT)')
-        c.execute('CREATE TABLE IF NOT EXISTS feature (tag TEXT)')
-        c.execute('CREATE TABLE IF NOT EXISTS deadline (entry INT, date INT)')
-        c.execute('CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT)')
-        c.execute('PRAGMA user_version = 1')
-        schema_version += 1
-    
-    if schema_version == 1:
-        c.execute('ALTER TABLE entry ADD COLUMN remote_id TEXT')
-        c.execute('PRAGMA user_version = 2')
-        schema_version += 1
-
-    if schema_version == 2:
-        c.execute('INSERT INTO config (key, value) VALUES(?, ?)', ('project.id', str(uuid.uuid4())))
-        c.execute('PRAGMA user_version = 3')
-        schema_version += 1
-
+    migrate(db.cursor())
     db.commit()
     return db
 
+def backup_db(db, filename):
+    target = sqlite3.connect(filename)
+    try:
+        db.backup(target, pages = BACKUP_PAGES, sleep = 0.005)
+    finally:
+        target.close()
+
+def auto_backup(config):
+    if 'backup.dir' not in config:
+        return
+
+    now = int(time.time())
+    if now - int(config.get('last.backup', 0)) < float(config.get('backup.interval', 1)) * 24 * 60 * 60:
+        return
+
+    backup_dir = Path(config['backup.dir'])
+    backup_dir.mkdir(parents=True, exist_ok=True)
+    backup_db(config.db, str(backup_dir / datetime.now().strftime('pm-%Y%m%d-%H%M%S.db')))
+    config['last.backup'] = now
+
+    backups = sorted(backup_dir.glob('pm-*.db'))
+    for old in backups[:-int(config.get('backup.keep', 5))]:
+        old.unlink()
+
+def db_filename(db):
+    for row in db.execute('PRAGMA database_list'):
+        if row['name'] == 'main':
+            return row['file']
+
+def archive_filename(config):
+    return os.path.join(os.path.dirname(db_filename(config.db)), ARCHIVE_DB)
+
+def parse_duration(value):
+    m = re.match(r'^(?P<count>\d+)\s*(?P<unit>[hdwmy]?)$', value.strip())
+    if not m:
+        raise argparse.ArgumentTypeError('invalid duration "{}" - expected e.g. 12h, 3d, 2w, 6m or 1y'.format(value))
+
+    days = { 'h': 1 / 24, 'd': 1, '': 1, 'w': 7, 'm': 30, 'y': 365 }[m.group('unit')]
+    return int(m.group('count')) * days
+
 def display_date(date, full_date):
     if full_date:
         return date.strftime('%Y-%m-%d %H:%M')
@@ -188,22 +299,160 @@ def display_date(date, full_date):
         return humanize.naturaltime(now - date)
 
 def show_entries(tpm, console, args):
+    if args.format and (args.watch or args.all_projects):
+        console.print('[error]ERROR: --format can\'t be combined with --watch or --all-projects')
+        exit(1)
+
+    if args.all_projects:
+        show_all_projects(console, args.tags or [], args.all, args.dates)
+        return
+
+    if args.archived:
+        filename = archive_filename(tpm.config)
+        if not os.path.isfile(filename):
+            console.print('No archived issues')
+            return
+
+        archive_db = init_db(filename)
+        tpm = TeenyPM(Config(archive_db))
+
+    if args.format:
+        export.export(tpm.config.db, 'show', args.format, args.tags, args.all)
+        return
+
     tags = args.tags or []
-    if tags and ((tags.startswith('PM') and tags[2:].isdigit()) or tags.isdigit()):
+    if args.watch:
+        watch_entries(tpm, console, tags, args.all, args.dates, False, args.interval)
+    elif tags and ((tags.startswith('PM') and tags[2:].isdigit()) or tags.isdigit()):
         show_full_entry(console, tpm.fetch_entries((), tags)[0])
     else:
         show_entries_internal(tpm, console, tags, args.all, args.dates)
 
 def doing_entries(tpm, console, args):
-    show_entries_internal(tpm, console, [], False, args.dates, True)
+    if args.format and (args.watch or args.all_projects):
+        console.print('[error]ERROR: --format can\'t be combined with --watch or --all-projects')
+        exit(1)
+
+    if args.format:
+        export.export(tpm.config.db, 'doing', args.format)
+    elif args.all_projects:
+        show_all_projects(console, [], False, args.dates, True)
+    elif args.watch:
+        watch_entries(tpm, console, [], False, args.dates, True, args.interval)
+    else:
+        show_entries_internal(tpm, console, [], False, args.dates, True)
 
 def show_entries_internal(tpm, console, tags, all, full_dates, started = False):
-    total = 0
-    open = 0
+    entries, features = fetch_cached_entries(tpm, tags)
+    overdue = active_plugins[0].count_due(tpm.config, datetime.now())
+    render_entries(console, entries, features, all, full_dates, started, overdue)
+
+def db_change_counter(filename):
+    # PRAGMA data_version is only meaningful within one connection, so use the
+    # file change counter from the database header (offset 24) plus the WAL
+    # file's size and mtime, which between them change on every commit
+    with open(filename, 'rb') as fh:
+        counter = int.from_bytes(fh.read(100)[24:28], 'big')
+
+    try:
+        wal = os.stat(filename + '-wal')
+        return (counter, wal.st_size, wal.st_mtime_ns)
+    except FileNotFoundError:
+        return (counter,)
+
+def fetch_cached_entries(tpm, tags):
+    filename = os.path.abspath(db_filename(tpm.config.db))
+    cache_file = CACHE_DIR / '{}.json'.format(hashlib.sha1(filename.encode()).hexdigest())
+    key = [filename, list(db_change_counter(filename)), tags]
+
+    try:
+        with cache_file.open() as fh:
+            cached = json.load(fh)
+        if cached['key'] == key:
+            return ([entry_from_json(e) for e in cached['entries']], set(cached['features']))
+    except Exception:
+        pass
 
     entries = tpm.fetch_entries(tags, None)
     features = active_plugins[0].fetch_features(tpm.config)
 
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with cache_file.open('w') as fh:
+            json.dump({ 'key': key, 'entries': [entry_to_json(e) for e in entries], 'features': sorted(features) }, fh)
+    except OSError:
+        pass
+
+    return (entries, features)
+
+def entry_to_json(e):
+    return {
+        'id': e.id, 'state': e.state, 'msg': e.msg, 'points': e.points, 'remote_id': e.remote_id, 'tags': e.tags, 'uuid': e.uuid,
+        'history': [(h.event, h.date.isoformat()) for h in e.history],
+        'deadline': e.deadline.isoformat() if e.deadline else None
+    }
+
+def entry_from_json(d):
+    history = [Event(d['id'], event, datetime.fromisoformat(date)) for event, date in d['history']]
+    deadline = datetime.fromisoformat(d['deadline']) if d['deadline'] else None
+    return Entry(d['id'], d['state'], d['msg'], d['points'], d['remote_id'], d['tags'], history, deadline, d['uuid'])
+
+def fetch_project_entries(filename, tags):
+    # other projects are only read: init_db and Config writes would migrate
+    # their databases behind their backs
+    db = sqlite3.connect('file:{}?mode=ro'.format(filename), uri=True, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+    db.row_factory = sqlite3.Row
+
+    try:
+        if db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            return None
+
+        config = Config(db)
+        local = active_plugins[0]
+        return (local.fetch_issues(config, tags), local.fetch_features(config), local.count_due(config, datetime.now()))
+    finally:
+        db.close()
+
+def show_all_projects(console, tags, all, full_dates, started = False):
+    projects = {id: filename for id, filename in read_registry().items() if os.path.isfile(filename)}
+    if len(projects) == 0:
+        console.print('No projects registered - run [white]pm register[/] in a project to add it')
+        return
+
+    with ThreadPoolExecutor() as pool:
+        results = list(pool.map(lambda filename: fetch_project_entries(filename, tags), projects.values()))
+
+    entries = []
+    features = set()
+    overdue = 0
+
+    for filename, result in zip(projects.values(), results):
+        name = os.path.basename(os.path.dirname(filename))
+        if result is None:
+            console.print('[dim]Skipping [remote]{}[/] - run pm there once to upgrade its database'.format(name), highlight=False)
+            continue
+
+        project_entries, project_features, project_overdue = result
+        for e in project_entries:
+            e.project = name
+
+        entries += project_entries
+        features |= project_features
+        overdue += project_overdue
+
+    # each project's entries are already in order, and the sort is stable
+    state_order = ['doing', 'backlog', 'done']
+    entries.sort(key=lambda e: state_order.index(e.state))
+
+    console.print(entries_view(entries, features, all, full_dates, started, overdue, projects = True))
+
+def render_entries(console, entries, features, all, full_dates, started = False, overdue = 0):
+    console.print(entries_view(entries, features, all, full_dates, started, overdue))
+
+def entries_view(entries, features, all, full_dates, started = False, overdue = 0, projects = False):
+    total = 0
+    open = 0
+
     buckets = {}
 
     for e in entries:
@@ -218,28 +467,25 @@ def show_entries_internal(tpm, console, tags, all, full_dates, started = False):
         if e.open:
             open += 1
 
-        bt = 'misc'
-        for t in list(e.tags):
-            if t in features:
-                e.tags.remove(t)
-                bt = t
-                break
+        bt = next((t for t in e.tags if t in features), 'misc')
+        etags = [t for t in e.tags if t != bt]
 
         if bt in buckets:
-            buckets[bt].append(e)
+            buckets[bt].append((e, etags))
         else:
-            buckets[bt] = [e]
+            buckets[bt] = [(e, etags)]
 
     now = datetime.now().strftime('%Y-%m-%d %H:%M')
 
-    console.print('[white][bold]{}[/bold]/{}[/white] issues [dim]| {} | teenypm v{}'.format(open, total, now, __version__), highlight=False)
+    overdue = '[date.overdue]{} overdue[/] '.format(overdue) if overdue else ''
+    header = Text.from_markup('[white][bold]{}[/bold]/{}[/white] issues {}[dim]| {} | teenypm v{}'.format(open, total, overdue, now, __version__))
+
+    columns = ["id", "tags", Column("msg", style = "msg"), Column("dates", justify = 'right'), "points"]
+    if projects:
+        columns.insert(1, "project")
 
     table = Table(
-        "id",
-        "tags",
-        Column("msg", style = "msg"),
-        Column("dates", justify = 'right'),
-        "points",
+        *columns,
         show_header = False,
         show_edge = False,
         box = box.SIMPLE,
@@ -248,14 +494,14 @@ def show_entries_internal(tpm, console, tags, all, full_dates, started = False):
 
     for b in buckets:
         bstyle = 'bucket.done'
-        for e in buckets[b]:
+        for e, _ in buckets[b]:
             if e.open:
                 bstyle = 'bucket.open'
                 break
 
-        table.add_row('{} ({})'.format(b, len(buckets[b])), None, None, None, None, style = bstyle)
+        table.add_row('{} ({})'.format(b, len(buckets[b])), *[None] * (len(columns) - 1), style = bstyle)
 
-        for e in buckets[b]:
+        for e, etags in buckets[b]:
             row_style = None
 
             if all and not e.open:
@@ -276,18 +522,47 @@ def show_entries_internal(tpm, console, tags, all, full_dates, started = False):
             else:
                 dates = '[date.created]{}'.format('{}'.format(display_date(e.created, full_dates)))
 
-            tags = ['[tag.default]{}[/]'.format(t) if t != 'bug' or e.deadline else '[tag.bug]bug[/]' for t in sorted(e.tags)]
+            tags = ['[tag.default]{}[/]'.format(t) if t != 'bug' or e.deadline else '[tag.bug]bug[/]' for t in sorted(etags)]
             display_tags = ','.join(tags)
 
-            msg = e.summary()
             if e.points > 1:
-                points = '[points]{}[/]'.format(str(points))
+                points = '[points]{}[/]'.format(str(e.points))
             else:
                 points = ''
 
-            table.add_row(e.displayid(), display_tags, e.summary(), dates, points, style = row_style)
+            row = [e.displayid(), display_tags, e.summary(), dates, points]
+            if projects:
+                row.insert(1, '[remote]{}[/]'.format(e.project))
 
-    console.print(table)
+            table.add_row(*row, style = row_style)
+
+    return Group(header, table)
+
+def watch_entries(tpm, console, tags, all, full_dates, started = False, interval = 2):
+    # data_version changes whenever another connection commits to the db, so
+    # only refetch then - in between just re-render to keep relative dates fresh
+    db = tpm.config.db
+    version = None
+    rendered = 0
+
+    try:
+        with Live(console = console, auto_refresh = False) as live:
+            while True:
+                current = db.execute('PRAGMA data_version').fetchone()[0]
+                if current != version:
+                    version = current
+                    entries = tpm.fetch_entries(tags, None)
+                    features = active_plugins[0].fetch_features(tpm.config)
+                    rendered = 0
+
+                if time.time() - rendered >= WATCH_TICK:
+                    overdue = active_plugins[0].count_due(tpm.config, datetime.now())
+                    live.update(entries_view(entries, features, all, full_dates, started, overdue), refresh = True)
+                    rendered = time.time()
+
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
 
 def show_full_entry(console, e):
     tags = ['[tag.default]{}[/]'.format(t) if t != 'bug' or e.deadline else '[tag.bug]bug[/ ]' for t in sorted(e.tags)]
@@ -300,10 +575,113 @@ def show_full_entry(console, e):
     console.print(('{} | {} | [date.created]{}[/] | [points]{}').format(e.displayid(), display_tags, dates, e.points))
     console.print('[msg]' + e.msg)
 
+def search_entries(tpm, console, args):
+    if args.format:
+        export.export(tpm.config.db, 'search', args.format, all = args.all, text = args.text)
+        return
+
+    text = args.text.lower()
+    entries = [e for e in tpm.fetch_entries([], None) if text in e.msg.lower()]
+    features = active_plugins[0].fetch_features(tpm.config)
+
+    render_entries(console, entries, features, args.all, args.dates)
+
+def due_entries(tpm, console, args):
+    now = datetime.now()
+    due = active_plugins[0].fetch_due(tpm.config, now + timedelta(days = args.within))
+
+    for row in due:
+        if row['date'] < now:
+            dates = '[date.overdue]due {}'.format(display_date(row['date'], args.dates))
+        else:
+            dates = '[date.soon]due {}'.format(display_date(row['date'], args.dates))
+
+        console.print('[id.local]{:>4}[/] [msg]{}[/] {}'.format(row['id'], row['msg'].split('\n')[0], dates), highlight=False)
+
+    if len(due) == 0:
+        console.print('Nothing due')
+
+    if args.exit_code and len(due) > 0:
+        exit(1)
+
 def show_tags(tpm, console, args):
-    c = tpm.db.cursor()
-    for row in c.execute('SELECT tag, COUNT(*) as count FROM tag GROUP BY tag ORDER BY tag'):
-        console.print('[tag.default]{}[/] - [msg]{}[/]'.format(row['tag'], row['count']))
+    if args.format:
+        export.export(tpm.config.db, 'tags', args.format)
+        return
+
+    c = tpm.config.db.cursor()
+    for row in c.execute('SELECT t.name, COUNT(*) as count FROM entry_tag et JOIN tags t ON t.id = et.tag_id GROUP BY t.id ORDER BY t.name'):
+        console.print('[tag.default]{}[/] - [msg]{}[/]'.format(row['name'], row['count']))
+
+def display_days(days):
+    if days is None:
+        return '-'
+    return humanize.naturaldelta(timedelta(days = days))
+
+def show_stats(tpm, console, args):
+    stats = active_plugins[0].fetch_stats(tpm.config, args.weeks)
+
+    if args.json:
+        print(json.dumps(stats, indent = 2))
+        return
+
+    summary = stats['summary']
+    console.print('[white][bold]{}[/bold][/white] issues closed [dim]| teenypm v{}'.format(summary['closed'], __version__), highlight=False)
+    console.print('lead time  [msg]{}[/] avg, [msg]{}[/] median'.format(display_days(summary['lead_time_avg_days']), display_days(summary['lead_time_median_days'])))
+    console.print('cycle time [msg]{}[/] avg, [msg]{}[/] median'.format(display_days(summary['cycle_time_avg_days']), display_days(summary['cycle_time_median_days'])))
+
+    table = Table("week of", "closed", Column("points", style = "points"), box = box.SIMPLE, title = 'throughput')
+    for row in stats['weekly']:
+        table.add_row(row['week'], str(row['closed']), str(row['points']))
+    console.print(table)
+
+    if stats['burndown']:
+        table = Table("feature", "week of", Column("burned", style = "points"), "remaining", box = box.SIMPLE, title = 'burndown')
+        for row in stats['burndown']:
+            table.add_row('[tag.default]{}[/]'.format(row['tag']), row['week'], str(row['points']), '{}/{}'.format(row['remaining'], row['total']))
+        console.print(table)
+
+def archive_entries(tpm, console, args):
+    filename = archive_filename(tpm.config)
+    archive_db = init_db(filename)
+    archive_config = Config(archive_db)
+    archive_config['project.id'] = tpm.config['project.id']
+    archive_db.close()
+
+    count = active_plugins[0].archive_entries(tpm.config, filename, args.older_than)
+    console.print('Archived [bold]{}[/] closed issues to [white]{}'.format(count, filename))
+
+def vacuum_db(tpm, console, args):
+    filename = db_filename(tpm.config.db)
+    size = os.path.getsize(filename)
+
+    active_plugins[0].vacuum(tpm.config)
+    console.print('Vacuumed [white]{}[/] - {} -> {}'.format(filename, humanize.naturalsize(size), humanize.naturalsize(os.path.getsize(filename))))
+
+def register_project(tpm, console, args):
+    projects = read_registry()
+
+    if tpm is None:
+        # this project's database has gone, so unregister it by location instead
+        filename = os.path.abspath(DB_FILE)
+        id = next((id for id, f in projects.items() if f == filename), None)
+    else:
+        id = tpm.config['project.id']
+        filename = os.path.abspath(db_filename(tpm.config.db))
+
+    if args.remove:
+        if projects.pop(id, None):
+            write_registry(projects)
+            console.print('Unregistered [white]{}'.format(filename))
+        else:
+            console.print('[white]{}[/] is not registered'.format(filename))
+    else:
+        projects[id] = filename
+        write_registry(projects)
+        console.print('Registered [white]{}'.format(filename))
+
+def show_status(tpm, console, args):
+    status(args.format)
 
 def add_entry(tpm, console, args):
     msg = args.desc
@@ -458,12 +836,13 @@ def sync(config, force):
 
     config['last.sync'] = now
 
-    if len(active_plugins) == 1:
-        return
-
-    p1 = active_plugins[0]
-    p2 = active_plugins[1]
+    for p in active_plugins[1:]:
+        if hasattr(p, 'sync'):
+            p.sync(config)
+        else:
+            sync_issues(config, active_plugins[0], p)
 
+def sync_issues(config, p1, p2):
     local_lookup = {}
     local_issues = p1.fetch_issues(config)
     remote_issues = p2.fetch_issues(config)
@@ -473,6 +852,7 @@ def sync(config, force):
             local_lookup[issue.remote_id] = issue
         elif issue.msg != '':
             p2.add_entry(config, issue)
+            p1.update_remote_id(config, issue)
             print('Local issue pushed: {} - {}'.format(issue.displayid(), issue.summary()))
 
     for issue in remote_issues:
@@ -505,7 +885,7 @@ def remote_plugin(tpm, console, args):
         else:
             plugin.remove(config)
             del config[plugin_cp]
-            activate_plugins.remove(args.plugin)
+            active_plugins[:] = [p for p in active_plugins if p.__name__ != plugin.__name__]
             console.print('Removed [remote]{}[/] remote'.format(args.plugin))
     else:
         if plugin_enabled:
@@ -513,10 +893,79 @@ def remote_plugin(tpm, console, args):
         else:
             if plugin.setup(config):
                 config[plugin_cp] = 'true'
-                activate_plugins.append(args.plugin)
+                active_plugins.append(plugin)
                 console.print('Remote [remote]{}[/] has been set up .. syncing issues ..'.format(args.plugin))
                 sync(config, True)
 
+def webhook_server(tpm, console, args):
+    github = next((p for p in active_plugins if p.__name__ == 'plugins.github'), None)
+    if not github:
+        console.print('[error]ERROR: the [remote]github[/] remote has not been set up')
+        exit(1)
+
+    secret = args.secret or os.getenv(WEBHOOK_SECRET_ENV)
+    if not secret:
+        console.print('[error]ERROR: a webhook secret is required - pass --secret or set {}'.format(WEBHOOK_SECRET_ENV))
+        exit(1)
+
+    console.print('Listening for GitHub webhooks on [white]http://127.0.0.1:{}[/] .. press Ctrl-C to stop'.format(args.port))
+    github.serve_webhook(tpm.config, active_plugins[0], args.port, secret)
+
+def backup_entries(tpm, console, args):
+    config = tpm.config
+
+    if args.no_auto:
+        for key in ['backup.dir', 'backup.keep', 'backup.interval', 'last.backup']:
+            config.pop(key, None)
+        console.print('Automatic backups turned off')
+
+    elif args.auto:
+        config['backup.dir'] = os.path.abspath(args.auto)
+        config['backup.keep'] = args.keep
+        config['backup.interval'] = args.every
+        console.print('Backing up to [white]{}[/] every {}, keeping the last {}'.format(
+            config['backup.dir'], display_days(args.every), args.keep))
+
+    elif args.dest:
+        dest = args.dest
+        if os.path.isdir(dest):
+            dest = os.path.join(dest, datetime.now().strftime('pm-%Y%m%d-%H%M%S.db'))
+
+        backup_db(config.db, dest)
+        console.print('Backed up to [white]{}'.format(dest))
+
+    else:
+        console.print('[error]ERROR: give a destination, or --auto <dir> / --no-auto')
+
+def restore_entries(tpm, console, args):
+    if not os.path.isfile(args.src):
+        console.print('[error]ERROR: [white]{}[/] not found'.format(args.src))
+        exit(1)
+
+    src = sqlite3.connect('file:{}?mode=ro'.format(args.src), uri=True)
+    try:
+        version = src.execute('PRAGMA user_version').fetchone()[0]
+        project = src.execute("SELECT value FROM config WHERE key = 'project.id'").fetchone() if version >= 3 else None
+    except sqlite3.DatabaseError as ex:
+        console.print('[error]ERROR: [white]{}[/] is not a teenypm database - {}'.format(args.src, ex))
+        exit(1)
+
+    if version == 0 or version > SCHEMA_VERSION:
+        console.print('[error]ERROR: [white]{}[/] has schema version {} - this teenypm supports 1 to {}'.format(args.src, version, SCHEMA_VERSION))
+        exit(1)
+
+    if project and project[0] != tpm.config['project.id'] and not args.force:
+        console.print('[error]ERROR: [white]{}[/] is a backup of a different project - use --force to restore it anyway'.format(args.src))
+        exit(1)
+
+    filename = db_filename(tpm.config.db)
+    src.backup(tpm.config.db, pages = BACKUP_PAGES, sleep = 0.005)
+    src.close()
+
+    # bring an older backup up to the current schema
+    init_db(filename).close()
+    console.print('Restored [white]{}[/] from schema version {}'.format(args.src, version))
+
 def available_plugins():
     plugins_dir = os.path.join(os.path.dirname(__file__), 'plugins')
 
@@ -544,13 +993,6 @@ def activate_plugins(config):
             active_plugins.append(import_plugin(key.split('.')[1]))
 
 def main():
-    db = init_db()
-    config = Config(db)
-
-    tpm = TeenyPM(config)
-
-    activate_plugins(tpm.config)
-
     parser = argparse.ArgumentParser(description="teenypm - a teeny, tiny CLI project manager | v" + __version__)
     parser.add_argument('-a', '--all', help='Show all issues, even closed', action="store_true")
     parser.add_argument('-d', '--dates', help='Show full dates', action="store_true")
@@ -562,12 +1004,43 @@ def main():
     p_show.add_argument('tags', nargs="?", type=str, help='Filter by comma-seperated tags')
     p_show.add_argument('-a', '--all', help='Show all issues, even closed', action="store_true")
     p_show.add_argument('-d', '--dates', help='Show full dates', action="store_true")
+    p_show.add_argument('--archived', help='Show archived issues', action="store_true")
+    p_show.add_argument('--all-projects', help='Show issues from all registered projects', action="store_true")
+    p_show.add_argument('--format', choices=export.FORMATS, help='Output machine-readable rows instead of a table')
+    p_show.add_argument('-w', '--watch', help='Keep showing issues, updating as they change', action="store_true")
+    p_show.add_argument('--interval', type=float, default=2, help='seconds between checks for changes when watching (defaults to 2)')
     p_show.set_defaults(func=show_entries)
 
     p_show = subparsers.add_parser('doing', help='show issues in progress')
     p_show.add_argument('-d', '--dates', help='Show full dates', action="store_true")
+    p_show.add_argument('--all-projects', help='Show issues from all registered projects', action="store_true")
+    p_show.add_argument('--format', choices=export.FORMATS, help='Output machine-readable rows instead of a table')
+    p_show.add_argument('-w', '--watch', help='Keep showing issues, updating as they change', action="store_true")
+    p_show.add_argument('--interval', type=float, default=2, help='seconds between checks for changes when watching (defaults to 2)')
     p_show.set_defaults(func=doing_entries)
 
+    p_due = subparsers.add_parser('due', help='show started issues that are overdue or due soon')
+    p_due.add_argument('-w', '--within', type=parse_duration, default=0, help='also show issues due within this time (e.g. 3d)')
+    p_due.add_argument('-d', '--dates', help='Show full dates', action="store_true")
+    p_due.add_argument('-x', '--exit-code', help='exit with status 1 if any issues are due', action="store_true")
+    p_due.set_defaults(func=due_entries)
+
+    p_search = subparsers.add_parser('search', help='search issue descriptions')
+    p_search.add_argument('text', type=str, help='text to search for')
+    p_search.add_argument('-a', '--all', help='Search all issues, even closed', action="store_true")
+    p_search.add_argument('-d', '--dates', help='Show full dates', action="store_true")
+    p_search.add_argument('--format', choices=export.FORMATS, help='Output machine-readable rows instead of a table')
+    p_search.set_defaults(func=search_entries)
+
+    p_stats = subparsers.add_parser('stats', help='show lead time, cycle time, throughput and burndown')
+    p_stats.add_argument('-w', '--weeks', type=int, default=8, help='number of weeks of throughput to show (defaults to 8)')
+    p_stats.add_argument('-j', '--json', help='output as JSON', action="store_true")
+    p_stats.set_defaults(func=show_stats)
+
+    p_status = subparsers.add_parser('status', help='print a one-line summary of issue counts, e.g. for a shell prompt')
+    p_status.add_argument('-f', '--format', type=str, default=DEFAULT_FORMAT, help='format string using {total}, {doing}, {backlog}, {open}, {done} and {overdue}')
+    p_status.set_defaults(func=show_status)
+
     p_add = subparsers.add_parser('add', help='add an issue')
     p_add.add_argument('desc', type=str, help='issue description')
     p_add.add_argument('points', type=int, nargs='?', default=1, help='effort points (defaults to 1)')
@@ -603,6 +1076,7 @@ def main():
     # tag management
 
     p_tags = subparsers.add_parser('tags', help='list tags')
+    p_tags.add_argument('--format', choices=export.FORMATS, help='Output machine-readable rows instead of a list')
     p_tags.set_defaults(func=show_tags)
 
     p_tag = subparsers.add_parser('tag', help='tag an issue')
@@ -620,11 +1094,40 @@ def main():
     p_commit.add_argument('id', type=str, help='issue id')
     p_commit.set_defaults(func=end_entry_and_commit)
 
+    p_archive = subparsers.add_parser('archive', help='move closed issues into the archive database')
+    p_archive.add_argument('--older-than', type=parse_duration, default=90, help='only archive issues closed longer ago than this (defaults to 90d)')
+    p_archive.set_defaults(func=archive_entries)
+
+    p_vacuum = subparsers.add_parser('vacuum', help='reclaim space and refresh query planner statistics')
+    p_vacuum.set_defaults(func=vacuum_db)
+
+    p_register = subparsers.add_parser('register', help='add this project to the global project registry')
+    p_register.add_argument('-r', '--remove', help='remove project from the registry', action='store_true')
+    p_register.set_defaults(func=register_project)
+
     p_remote = subparsers.add_parser('remote', help='integrate a remote API')
     p_remote.add_argument('plugin', type=str, help='"supported: github"')
     p_remote.add_argument('-r', '--remove', help='remove remote', action='store_true')
     p_remote.set_defaults(func=remote_plugin)
 
+    p_webhook = subparsers.add_parser('webhook', help='listen for GitHub webhook events and apply them locally')
+    p_webhook.add_argument('-p', '--port', type=int, default=8765, help='port to listen on (defaults to 8765)')
+    p_webhook.add_argument('--secret', type=str, help='webhook secret (defaults to ${})'.format(WEBHOOK_SECRET_ENV))
+    p_webhook.set_defaults(func=webhook_server)
+
+    p_backup = subparsers.add_parser('backup', help='back up the database without blocking other writers')
+    p_backup.add_argument('dest', type=str, nargs='?', help='file or directory to back up to')
+    p_backup.add_argument('--auto', type=str, metavar='DIR', help='turn on automatic rotating backups into DIR')
+    p_backup.add_argument('--every', type=parse_duration, default=1, help='time between automatic backups (defaults to 1d)')
+    p_backup.add_argument('--keep', type=int, default=5, help='number of automatic backups to keep (defaults to 5)')
+    p_backup.add_argument('--no-auto', help='turn off automatic backups', action='store_true')
+    p_backup.set_defaults(func=backup_entries)
+
+    p_restore = subparsers.add_parser('restore', help='restore the database from a backup')
+    p_restore.add_argument('src', type=str, help='backup file to restore')
+    p_restore.add_argument('-f', '--force', help='restore even if the backup is from a different project', action='store_true')
+    p_restore.set_defaults(func=restore_entries)
+
     args = parser.parse_args()
 
     console = Console(theme = Theme({
@@ -644,6 +1147,20 @@ def main():
         "remote": "bold white"
     }))
 
+    # these work from anywhere, so don't leave a new pm.db behind when there's no project here
+    filename = find_db()
+    if not os.path.isfile(filename) and (getattr(args, 'all_projects', False) or (getattr(args, 'func', None) == register_project and args.remove)):
+        active_plugins.append(import_plugin('local'))
+        args.func(None, console, args)
+        return
+
+    db = init_db(filename)
+    config = Config(db)
+
+    tpm = TeenyPM(config)
+
+    activate_plugins(tpm.config)
+
     if hasattr(args, 'id'):
         args.id = map_id(args.id)
 
@@ -660,6 +1177,8 @@ def main():
     else:
         args.func(tpm, console, args)
 
+    tpm.flush()
+    auto_backup(config)
     db.close()
 
 if __name__ == '__main__':